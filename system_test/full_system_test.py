@@ -1,44 +1,104 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from __future__ import print_function
+import atexit
 import tempfile
 import argparse
 import subprocess
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import urllib3
+try:
+  import orjson as _json
+except ImportError:
+  import json as _json
 import os
 import shutil
+import signal
 import time
 import socket
 import sys
-from urlparse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import unittest
 
 RQLITED_PATH = os.environ['RQLITED_PATH']
+if not (os.path.isfile(RQLITED_PATH) and os.access(RQLITED_PATH, os.X_OK)):
+  raise SystemExit('RQLITED_PATH %r is not executable' % RQLITED_PATH)
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+NONSENSE_STATEMENT = _json.dumps(['nonsense'])
+
+# Node directories live under a single per-run directory, on tmpfs where
+# available so rqlited's fsyncs are cheap.
+_tmp_base = os.environ.get('RQLITE_TEST_TMPDIR')
+if _tmp_base is None and os.path.isdir('/dev/shm'):
+  _tmp_base = '/dev/shm'
+SUITE_TMP = tempfile.mkdtemp(prefix='rqlite-tests-', dir=_tmp_base)
+atexit.register(shutil.rmtree, SUITE_TMP, ignore_errors=True)
+
+# rqlited runs in its own session, so signals sent to the test runner don't
+# reach it. Kill every rqlited still running when the runner exits, before
+# SUITE_TMP is removed. SIGTERM is handled like Ctrl-C, which unittest
+# re-raises rather than recording as a test error, so the run stops and this
+# happens when CI kills the run too.
+_processes = set()
+def _kill_processes():
+  for p in list(_processes):
+    try:
+      os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+      pass
+atexit.register(_kill_processes)
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+def _poll(pred, timeout, initial=0.025, factor=1.5, cap=0.5):
+  '''Call pred until it returns a true value, and return that value. Sleeps
+  between calls back off exponentially, so events that complete quickly are
+  detected quickly'''
+  deadline = time.time() + timeout
+  i = 0
+  while True:
+    r = pred()
+    if r:
+      return r
+    if time.time() > deadline:
+      raise Exception('timeout')
+    time.sleep(min(cap, initial * factor**i))
+    i+=1
 
 class Node(object):
   def __init__(self, path, node_id, api_addr=None, raft_addr=None, dir=None):
+    self._port_sockets = []
     if api_addr is None:
       api_addr = self._random_addr()
     if raft_addr is None:
       raft_addr = self._random_addr()
     if dir is None:
-      dir = tempfile.mkdtemp()
+      dir = tempfile.mkdtemp(dir=SUITE_TMP)
 
     self.path = path
     self.node_id = node_id
     self.api_addr = api_addr
     self.raft_addr = raft_addr
+    self._http = None
+    self._set_urls()
+    self._reset_http()
     self.dir = dir
     self.process = None
+    self._status_cache = (0, None)
+    self._status_ttl = 0.05
     self.stdout_file = os.path.join(dir, 'rqlited.log')
-    self.stdout_fd = open(self.stdout_file, 'w')
+    self.stdout_fd = os.open(self.stdout_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_APPEND, 0o644)
     self.stderr_file = os.path.join(dir, 'rqlited.err')
-    self.stderr_fd = open(self.stderr_file, 'w')
+    self.stderr_fd = os.open(self.stderr_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_APPEND, 0o644)
+    self.session = requests.Session()
+    self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
   def scramble_network(self):
     self.api_addr = self._random_addr()
     self.raft_addr = self._random_addr()
+    self._set_urls()
+    self._reset_http()
 
   def start(self, join=None, wait=True, timeout=30):
     if self.process is not None:
@@ -50,145 +110,218 @@ class Node(object):
     if join is not None:
       command += ['-join', 'http://' + join]
     command.append(self.dir)
-    self.process = subprocess.Popen(command, stdout=self.stdout_fd, stderr=self.stderr_fd)
-    t = 0
-    while wait:
-      if t > timeout:
-        raise Exception('timeout')
+    self._status_cache = (0, None)
+    self._release_ports()
+    self.process = subprocess.Popen(command, stdout=self.stdout_fd, stderr=self.stderr_fd,
+                                    close_fds=True, start_new_session=True)
+    _processes.add(self.process)
+    # A TCP connect is enough to tell when rqlited is listening, and is much
+    # cheaper than a full status request. A connect can still succeed without
+    # a server (a loopback self-connect), so confirm with status requests,
+    # polled within the same deadline.
+    host, port = self.api_addr.rsplit(':', 1)
+    def listening():
+      s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       try:
-        self.status()
-      except requests.exceptions.ConnectionError:
-        time.sleep(1)
-        t+=1
-      else:
-        break
+        return s.connect_ex((host, int(port))) == 0
+      finally:
+        s.close()
+    if wait:
+      deadline = time.time() + timeout
+      _poll(listening, timeout)
+      _poll(lambda: self._raft_state(5) is not None, max(0, deadline - time.time()))
     return self
 
   def stop(self):
     if self.process is None:
       return
-    self.process.kill()
+    os.killpg(self.process.pid, signal.SIGKILL)
     self.process.wait()
+    _processes.discard(self.process)
     self.process = None
+    self._status_cache = (0, None)
     return self
 
-  def status(self):
-    r = requests.get(self._status_url())
-    r.raise_for_status()
-    return r.json()
-
-  def is_leader(self):
-    try:
-      return self.status()['store']['raft']['state'] == 'Leader'
-    except requests.exceptions.ConnectionError:
-      return False
-
-  def is_follower(self):
+  def status(self, fresh=False, timeout=None):
+    ts, body = self._status_cache
+    if not fresh and time.time() - ts < self._status_ttl:
+      return body
+    # /status is polled heavily, so it skips the requests machinery and uses
+    # a urllib3 pool directly. Errors are raised as their requests
+    # equivalents so callers handle all endpoints the same way.
     try:
-      return self.status()['store']['raft']['state'] == 'Follower'
-    except requests.exceptions.ConnectionError:
-      return False
+      r = self._http.urlopen('GET', '/status', timeout=timeout)
+    except urllib3.exceptions.NewConnectionError as e:
+      # Checked first, as urllib3 makes this a subclass of its TimeoutError.
+      raise requests.exceptions.ConnectionError(e)
+    except urllib3.exceptions.TimeoutError as e:
+      raise requests.exceptions.Timeout(e)
+    except urllib3.exceptions.HTTPError as e:
+      raise requests.exceptions.ConnectionError(e)
+    if r.status >= 400:
+      raise requests.exceptions.HTTPError('%d error for url: %s' % (r.status, self.status_url))
+    body = _json.loads(r.data)
+    self._status_cache = (time.time(), body)
+    return body
+
+  def is_leader(self, timeout=5):
+    return self._raft_state(timeout) == 'Leader'
+
+  def is_follower(self, timeout=5):
+    return self._raft_state(timeout) == 'Follower'
 
   def wait_for_leader(self, timeout=30):
-    l = None
-    t = 0
-    while l == None or l is '':
-      if t > timeout:
-        raise Exception('timeout')
-      l = self.status()['store']['leader']
-      time.sleep(1)
-      t+=1
-    return l
+    return _poll(lambda: self.status(fresh=True)['store']['leader'], timeout)
 
   def applied_index(self):
-    return self.status()['store']['raft']['applied_index']
+    return self.status(fresh=True)['store']['raft']['applied_index']
 
   def wait_for_applied_index(self, index, timeout=30):
-    t = 0
-    while self.status()['store']['raft']['applied_index'] != index:
-      if t > timeout:
-        raise Exception('timeout')
-      time.sleep(1)
-      t+=1
+    _poll(lambda: self.status(fresh=True)['store']['raft']['applied_index'] == index, timeout)
 
   def query(self, statement, level='weak'):
-    r = requests.get(self._query_url(), params={'q': statement, 'level': level})
+    r = self.session.get(self.query_url, params={'q': statement, 'level': level})
     r.raise_for_status()
-    return r.json()
+    return _json.loads(r.content)
 
   def execute(self, statement):
-    r = requests.post(self._execute_url(), data=json.dumps([statement]))
+    self._status_cache = (0, None)
+    r = self.session.post(self.execute_url, data=_json.dumps([statement]), headers=JSON_HEADERS)
     r.raise_for_status()
-    return r.json()
+    return _json.loads(r.content)
 
   def redirect_addr(self):
-    r = requests.post(self._execute_url(), data=json.dumps(['nonsense']), allow_redirects=False)
+    r = self.session.post(self.execute_url, data=NONSENSE_STATEMENT, headers=JSON_HEADERS,
+                          allow_redirects=False)
     if r.status_code == 301:
       return urlparse(r.headers['Location']).netloc
 
-  def _status_url(self):
-    return 'http://' + self.api_addr + '/status'
-  def _query_url(self):
-    return 'http://' + self.api_addr + '/db/query'
-  def _execute_url(self):
-    return 'http://' + self.api_addr + '/db/execute'
+  def _raft_state(self, timeout):
+    try:
+      return self.status(timeout=timeout)['store']['raft']['state']
+    except requests.exceptions.RequestException:
+      return None
+  def _set_urls(self):
+    self.status_url = 'http://' + self.api_addr + '/status'
+    self.query_url = 'http://' + self.api_addr + '/db/query'
+    self.execute_url = 'http://' + self.api_addr + '/db/execute'
+  def _reset_http(self, reopen=True):
+    if self._http is not None:
+      self._http.close()
+      self._http = None
+    if reopen:
+      host, port = self.api_addr.rsplit(':', 1)
+      self._http = urllib3.HTTPConnectionPool(host, int(port), maxsize=2, retries=False)
   def _random_addr(self):
+    # Keep the socket bound so the port stays reserved until rqlited is
+    # about to bind it, see _release_ports().
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind(('localhost', 0))
+    self._port_sockets.append(s)
     return ':'.join([s.getsockname()[0], str(s.getsockname()[1])])
+  def _release_ports(self):
+    for s in self._port_sockets:
+      s.close()
+    self._port_sockets = []
 
   def __eq__(self, other):
     return self.node_id == other.node_id
   def __str__(self):
     return '%s:[%s]:[%s]:[%s]' % (self.node_id, self.api_addr, self.raft_addr, self.dir)
-  def __del__(self):
-    self.stdout_fd.close()
-    self.stderr_fd.close()
+  def close(self):
+    self._release_ports()
+    self._reset_http(reopen=False)
+    self.session.close()
+    if self.stdout_fd is not None:
+      os.close(self.stdout_fd)
+      self.stdout_fd = None
+    if self.stderr_fd is not None:
+      os.close(self.stderr_fd)
+      self.stderr_fd = None
 
 def deprovision_node(node):
   node.stop()
+  node.close()
   shutil.rmtree(node.dir)
   node = None
 
+def redirect_addrs(nodes):
+  '''Returns the redirect address of each node, probing the nodes concurrently'''
+  if not nodes:
+    return []
+  with ThreadPoolExecutor(max_workers=len(nodes)) as ex:
+    return list(ex.map(lambda n: n.redirect_addr(), nodes))
+
 class Cluster(object):
   def __init__(self, nodes):
     self.nodes = nodes
   def wait_for_leader(self, node_exc=None, timeout=30):
-    t = 0
-    while True:
-      if t > timeout:
-        raise Exception('timeout')
+    def leader():
+      # Any running node can say who the leader is, so ask the first one
+      # that answers rather than asking every node whether it is the leader.
       for n in self.nodes:
-        if node_exc is not None and n == node_exc:
+        if n.process is None:
+          continue
+        try:
+          addr = n.status(fresh=True)['store']['leader']
+        except requests.exceptions.ConnectionError:
           continue
-        if n.is_leader():
-          return n
-      time.sleep(1)
-      t+=1
-  def followers(self):
-    return [n for n in self.nodes if n.is_follower()]
+        for l in self.nodes:
+          if node_exc is not None and l == node_exc:
+            continue
+          if l.process is not None and l.raft_addr == addr:
+            return l
+        return None
+    return _poll(leader, timeout)
+  def followers(self, timeout=5):
+    return [n for n in self.nodes if n.is_follower(timeout)]
+  def wait_for_all_applied(self, index, timeout=30):
+    '''Wait until every running node has applied at least the given index'''
+    nodes = [n for n in self.nodes if n.process is not None]
+    if not nodes:
+      return
+    with ThreadPoolExecutor(max_workers=len(nodes)) as ex:
+      def applied():
+        return all(i >= index for i in ex.map(lambda n: n.applied_index(), nodes))
+      _poll(applied, timeout)
+  def ensure_all_running(self):
+    for n in self.nodes:
+      if n.process is None:
+        n.start()
+        n.wait_for_leader()
   def deprovision(self):
     for n in self.nodes:
       deprovision_node(n)
 
 class TestEndToEnd(unittest.TestCase):
-  def setUp(self):
+  @classmethod
+  def setUpClass(cls):
     n0 = Node(RQLITED_PATH, '0')
     n0.start()
     n0.wait_for_leader()
 
+    # The joining nodes are independent of each other, so bring them up
+    # concurrently. Each worker only touches its own Node.
     n1 = Node(RQLITED_PATH, '1')
-    n1.start(join=n0.api_addr)
-    n1.wait_for_leader()
-
     n2 = Node(RQLITED_PATH, '2')
-    n2.start(join=n0.api_addr)
-    n2.wait_for_leader()
+    with ThreadPoolExecutor(max_workers=2) as ex:
+      fs = [ex.submit(lambda n: n.start(join=n0.api_addr).wait_for_leader(), n) for n in [n1, n2]]
+      for f in fs:
+        f.result()
 
-    self.cluster = Cluster([n0, n1, n2])
+    cls.cluster = Cluster([n0, n1, n2])
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.cluster.deprovision()
+
+  def setUp(self):
+    self.cluster.wait_for_leader().execute('DROP TABLE IF EXISTS foo')
 
   def tearDown(self):
-    self.cluster.deprovision()
+    # Some tests stop nodes, bring them back for the next test.
+    self.cluster.ensure_all_running()
 
   def test_election(self):
     '''Test basic leader election'''
@@ -203,24 +336,24 @@ class TestEndToEnd(unittest.TestCase):
 
     n = self.cluster.wait_for_leader()
     j = n.execute('CREATE TABLE foo (id INTEGER NOT NULL PRIMARY KEY, name TEXT)')
-    self.assertEqual(str(j), "{u'results': [{}]}")
+    self.assertEqual(j, {'results': [{}]})
     j = n.execute('INSERT INTO foo(name) VALUES("fiona")')
-    self.assertEqual(str(j), "{u'results': [{u'last_insert_id': 1, u'rows_affected': 1}]}")
+    self.assertEqual(j, {'results': [{'last_insert_id': 1, 'rows_affected': 1}]})
     j = n.query('SELECT * FROM foo')
-    self.assertEqual(str(j), "{u'results': [{u'values': [[1, u'fiona']], u'types': [u'integer', u'text'], u'columns': [u'id', u'name']}]}")
+    self.assertEqual(j, {'results': [{'values': [[1, 'fiona']], 'types': ['integer', 'text'], 'columns': ['id', 'name']}]})
 
     n0 = self.cluster.wait_for_leader().stop()
     n1 = self.cluster.wait_for_leader(node_exc=n0)
     j = n1.query('SELECT * FROM foo')
-    self.assertEqual(str(j), "{u'results': [{u'values': [[1, u'fiona']], u'types': [u'integer', u'text'], u'columns': [u'id', u'name']}]}")
+    self.assertEqual(j, {'results': [{'values': [[1, 'fiona']], 'types': ['integer', 'text'], 'columns': ['id', 'name']}]})
     j = n1.execute('INSERT INTO foo(name) VALUES("declan")')
-    self.assertEqual(str(j), "{u'results': [{u'last_insert_id': 2, u'rows_affected': 1}]}")
+    self.assertEqual(j, {'results': [{'last_insert_id': 2, 'rows_affected': 1}]})
 
     n0.start()
     n0.wait_for_leader()
-    n0.wait_for_applied_index(n1.applied_index())
+    self.cluster.wait_for_all_applied(n1.applied_index())
     j = n0.query('SELECT * FROM foo', level='none')
-    self.assertEqual(str(j), "{u'results': [{u'values': [[1, u'fiona'], [2, u'declan']], u'types': [u'integer', u'text'], u'columns': [u'id', u'name']}]}")
+    self.assertEqual(j, {'results': [{'values': [[1, 'fiona'], [2, 'declan']], 'types': ['integer', 'text'], 'columns': ['id', 'name']}]})
 
   def test_leader_redirect(self):
     '''Test that followers supply the correct leader redirects (HTTP 301)'''
@@ -228,13 +361,12 @@ class TestEndToEnd(unittest.TestCase):
     l = self.cluster.wait_for_leader()
     fs = self.cluster.followers()
     self.assertEqual(len(fs), 2)
-    for n in fs:
-      self.assertEqual(l.api_addr, n.redirect_addr())
+    self.assertEqual([l.api_addr]*len(fs), redirect_addrs(fs))
 
     l.stop()
     n = self.cluster.wait_for_leader(node_exc=l)
-    for f in self.cluster.followers():
-      self.assertEqual(n.api_addr, f.redirect_addr())
+    fs = self.cluster.followers()
+    self.assertEqual([n.api_addr]*len(fs), redirect_addrs(fs))
 
   def test_node_restart_different_ip(self):
     ''' Test that a node restarting with different IP addresses successfully rejoins the cluster'''
@@ -245,16 +377,16 @@ class TestEndToEnd(unittest.TestCase):
     l = self.cluster.wait_for_leader()
     j = l.execute('CREATE TABLE foo (id INTEGER NOT NULL PRIMARY KEY, name TEXT)')
 
-    self.assertEqual(str(j), "{u'results': [{}]}")
+    self.assertEqual(j, {'results': [{}]})
     j = l.execute('INSERT INTO foo (name) VALUES("fiona")')
-    self.assertEqual(str(j), "{u'results': [{u'last_insert_id': 1, u'rows_affected': 1}]}")
+    self.assertEqual(j, {'results': [{'last_insert_id': 1, 'rows_affected': 1}]})
 
     f.scramble_network()
     f.start(join=l.api_addr)
     f.wait_for_leader()
-    f.wait_for_applied_index(l.applied_index())
+    self.cluster.wait_for_all_applied(l.applied_index())
     j = f.query('SELECT * FROM foo', level='none')
-    self.assertEqual(str(j), "{u'results': [{u'values': [[1, u'fiona']], u'types': [u'integer', u'text'], u'columns': [u'id', u'name']}]}")
+    self.assertEqual(j, {'results': [{'values': [[1, 'fiona']], 'types': ['integer', 'text'], 'columns': ['id', 'name']}]})
 
 if __name__ == "__main__":
   unittest.main(verbosity=2)